@@ -1,21 +1,72 @@
 import subprocess
 import os
 import sys
-import pysam
+import shutil
+import contextlib
 import re
 import gzip
 import argparse
 import resource
 import psutil
 import time
+import atexit
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 #%% Functions
 
+FASTQ_CHUNK_SIZE = 1 << 20  # Max bytes pulled from the FASTQ stream per read1() call
+BWA_INDEX_SUFFIXES = (".amb", ".ann", ".bwt", ".pac", ".sa")  # Index files loaded by bwa mem
+PIPELINE_HEADROOM_MB = 2048  # Memory kept out of the sort budget for bwa mem batches (-K) and this script
+PHRED_OFFSET = 33  # Phred+33 encoding of the FASTQ qualities
+_RE_SN_LINE = re.compile(r"SN\t([^:]+):\t([\d\.]+)")  # samtools stats summary number
 
 def set_memory_limit_gb(max_gb):
-    """Limit the memory usage of the script (including child processes)."""
+    """Limit the memory usage of the script.
+    Only the soft limit is lowered, so child processes can lift it again (see release_memory_limit)."""
     max_bytes = max_gb * 1024 ** 3
-    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+def release_memory_limit():
+    """Used as preexec_fn of the child processes: rlimits are inherited through fork(),
+    so without this bwa and samtools sort would be capped by the limit of the script."""
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+
+def temporary_file_path(fallback_dir, prefix):
+    """Create a temporary file in RAM (/dev/shm) when available, otherwise in fallback_dir.
+    The file is removed when the script exits, also when the pipeline fails."""
+    shm_dir = "/dev/shm"
+    tmp_dir = shm_dir if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK) else fallback_dir
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, prefix=prefix, delete=False) as f:
+        path = f.name
+    atexit.register(remove_if_exists, path)
+    return path
+
+def remove_if_exists(path):
+    """Remove an intermediate file, if it is still there."""
+    try:
+        os.remove(path)
+        print(f"Removed: {path}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error during cleanup: {e}")
+
+def sort_memory_per_thread_mb(num_threads, reference, limit_gb):
+    """Memory for each samtools sort thread (-m), so the sort stays in RAM instead of
+    spilling temporary files. bwa mem runs alongside sort in the pipe and holds the whole
+    reference index, so sort gets what is left of limit_gb after the index and PIPELINE_HEADROOM_MB
+    (and at most half of the available RAM), split across its threads (between 128 MB and 4 GB)."""
+    available_mb = psutil.virtual_memory().available // (1024 * 1024)
+    index_mb = sum(os.path.getsize(reference + suffix) for suffix in BWA_INDEX_SUFFIXES
+                   if os.path.exists(reference + suffix)) // (1024 * 1024)
+    budget_mb = min(limit_gb * 1024 - index_mb - PIPELINE_HEADROOM_MB, available_mb // 2)
+    return min(max(budget_mb // num_threads, 128), 4096)
 
 def parse_args():
     """Collect the imput files"""
@@ -27,7 +78,7 @@ def parse_args():
     parser.add_argument("-o","--output_dir", default="output", help="Directory to save output files")
     parser.add_argument("-t","--threads", type=int, default=4, help="Number of threads to use (default: 4)")
     parser.add_argument("--stats", default=None, help="Stats report filename or path")
-    parser.add_argument("--keep_intermediates", type=str, choices=["yes", "no"], default="no", help="Keep intermediate SAM/BAM files (yes/no)")
+    parser.add_argument("--keep_intermediates", type=str, choices=["yes", "no"], default="no", help="Keep intermediate files, i.e. the raw samtools stats output (yes/no)")
 
     args = parser.parse_args() 
     # Initialize it and redefine stats in case of None, filename, or path
@@ -45,6 +96,12 @@ def parse_args():
 
     print(f"Stats report will be saved to: {args.stats}")
 
+    # bwa mem does not gain from hyper-threading, so use at most one thread per physical core
+    physical_cores = psutil.cpu_count(logical=False) or os.cpu_count()
+    if physical_cores and args.threads > physical_cores:
+        print(f"WARNING: {args.threads} threads requested but only {physical_cores} physical cores available, using {physical_cores}")
+        args.threads = physical_cores
+
 
     # Validate inputs (better be safe than sorry)
     if not os.path.exists(args.read1):
@@ -60,94 +117,125 @@ def parse_args():
     return args
 
 
-def parse_flagstat(flagstat_path, output_report_path):
+def parse_samtools_stats(samtools_stats_path, output_report_path):
     """ Parse the report (stats) file, saving the useful information.
-    Work for the output of samtools flagstat """
+    Work for the output of samtools stats (summary numbers, SN lines, and the MAPQ histogram).
+    Returns the average mapping quality (MAPQ) """
+
+    summary = {}
+    mapq_counts = {}  # MAPQ histogram: mapping quality -> number of reads
+    with open(samtools_stats_path, "r") as f:
+        for line in f:
+            if line.startswith("SN\t"):
+                m = _RE_SN_LINE.match(line)
+                if m:
+                    summary[m.group(1)] = float(m.group(2))
+            elif line.startswith("MAPQ\t"):
+                mapq, count = line.split("\t")[1:3]
+                mapq_counts[int(mapq)] = int(count)
+            elif mapq_counts:
+                break  # End of the MAPQ block, the sections after it are not needed
 
     stats = {}
-    with open(flagstat_path, "r") as f:
-        lines = f.readlines()
-
-    total_reads = None
-    mapped_reads = None
-    mapped_pct = None
-
-    for line in lines:
-        # Total reads
-        if "in total" in line:
-            m = re.search(r"(\d+) \+ \d+ in total", line)
-            if m:
-                total_reads = int(m.group(1))
-                stats["Total reads"] = total_reads
-
-        # Mapped reads
-        elif "mapped (" in line and "primary mapped" not in line:
-            m = re.search(r"(\d+) \+ \d+ mapped \(([\d\.]+)%", line)
-            if m:
-                mapped_reads = int(m.group(1))
-                mapped_pct = float(m.group(2))
-                stats["Mapped reads"] = f"{mapped_reads} ({mapped_pct}%)"
-
-        # Duplicated reads
-        elif "duplicates" in line and "primary duplicates" not in line:
-            m = re.search(r"(\d+) \+ \d+ duplicates", line)
-            if m and total_reads is not None:
-                dup_count = int(m.group(1))
-                dup_pct = 100 * dup_count / total_reads
-                stats["Duplicated reads"] = f"{dup_count} ({dup_pct:.2f}%)"
-
-        # Singletons
-        elif "singletons (" in line:
-            m = re.search(r"(\d+) \+ \d+ singletons \(([\d\.]+)%", line)
-            if m:
-                stats["Singletons"] = f"{m.group(1)} ({m.group(2)}%)"
-
-    # Calculate Unmapped reads and percentage
-    if total_reads is not None and mapped_reads is not None and mapped_pct is not None:
-        unmapped_reads = total_reads - mapped_reads
-        unmapped_pct = 100 - mapped_pct
-        stats["Unmapped reads"] = f"{unmapped_reads} ({unmapped_pct:.2f}%)"
+    total_reads = int(summary.get("raw total sequences", 0))
+    stats["Total reads"] = total_reads
+
+    def with_pct(count):
+        pct = 100 * count / total_reads if total_reads > 0 else 0
+        return f"{count} ({pct:.2f}%)"
+
+    # Mapped and unmapped reads
+    mapped_reads = int(summary.get("reads mapped", 0))
+    stats["Mapped reads"] = with_pct(mapped_reads)
+    stats["Unmapped reads"] = with_pct(total_reads - mapped_reads)
+
+    # Duplicated reads
+    stats["Duplicated reads"] = with_pct(int(summary.get("reads duplicated", 0)))
+
+    # Singletons: mapped reads of a pair whose mate is unmapped (none for single-end)
+    if summary.get("reads paired", 0) > 0:
+        singletons = mapped_reads - int(summary.get("reads mapped and paired", 0))
+    else:
+        singletons = 0
+    stats["Singletons"] = with_pct(singletons)
 
     # Write report
     with open(output_report_path, "w") as out:
         for key in ["Total reads", "Mapped reads", "Unmapped reads", "Duplicated reads", "Singletons"]:
-            if key in stats:
-                out.write(f"{key}: {stats[key]}\n")
-
-
-def average_base_quality(fastq_path):
-    """REQ04, -5 request the average base quality (Phred score) """
-    open_func = gzip.open if fastq_path.endswith('.gz') else open
-    total_quality = 0
+            out.write(f"{key}: {stats[key]}\n")
+
+    # samtools stats has no SN line for the mapping quality, its mean comes from the MAPQ histogram
+    n_mapq = sum(mapq_counts.values())
+    return sum(mapq * count for mapq, count in mapq_counts.items()) / n_mapq if n_mapq else 0
+
+
+@contextlib.contextmanager
+def open_fastq(fastq_path, threads=1):
+    """Open a FASTQ file (plain or .gz) as a binary stream.
+    Gzipped files are decompressed by an external pigz process when available,
+    which keeps the decompression off the Python thread; otherwise gzip is used."""
+    if not fastq_path.endswith('.gz'):
+        with open(fastq_path, 'rb') as f:
+            yield f
+    elif shutil.which("pigz") is None:
+        with gzip.open(fastq_path, 'rb') as f:
+            yield f
+    else:
+        pigz_cmd = ["pigz", "-dc", "-p", str(threads), fastq_path]
+        process = subprocess.Popen(pigz_cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, pigz_cmd)
+
+def average_base_quality(fastq_path, threads=1):
+    """REQ04, -5 request the average base quality (Phred score)
+    The FASTQ is read in large binary chunks and only the quality lines
+    (every 4th line) are summed, as a single NumPy sum of the raw bytes per chunk.
+    The Phred+33 offset is subtracted once at the end."""
+    total_ascii = 0
     total_bases = 0
-    with open_func(fastq_path, 'rt') as f:  # 'rt' means read text mode even for gzip
+    carry = bytearray()  # Incomplete last line of the previous chunk
+    line_index = 0  # Position (mod 4) within the record of the first complete line in carry
+    with open_fastq(fastq_path, threads) as f:
         while True:
-            header = f.readline()
-            if not header:
+            chunk = f.read1(FASTQ_CHUNK_SIZE)
+            if not chunk:
                 break
-            seq = f.readline().rstrip()
-            plus = f.readline()
-            qual = f.readline().rstrip()
-            qual_scores = [ord(ch) - 33 for ch in qual]  # Phred+33 decoding
-            total_quality += sum(qual_scores)
-            total_bases += len(qual_scores)
+            carry += chunk
+            end = carry.rfind(b"\n") + 1
+            if end == 0:
+                continue  # No complete line yet
+            lines = carry[:end].split(b"\n")
+            lines.pop()  # Empty string after the last newline
+            del carry[:end]
+            qual = b"".join(lines[(3 - line_index) % 4::4])
+            line_index = (line_index + len(lines)) % 4
+            # CRLF files: the \r ending each quality line is not a base (never a valid quality character either)
+            n_cr = qual.count(b"\r")
+            total_ascii += _byte_sum(qual) - n_cr * ord("\r")
+            total_bases += len(qual) - n_cr
+    # Last quality line without a trailing newline
+    if carry and line_index == 3:
+        qual = bytes(carry).rstrip()
+        total_ascii += _byte_sum(qual)
+        total_bases += len(qual)
+    total_quality = total_ascii - PHRED_OFFSET * total_bases
     return total_quality / total_bases if total_bases > 0 else 0
 
-def average_mapping_quality(bam_path):
-    """REQ04, -6 request the average mapping quality (MAPQ) """
-    bamfile = pysam.AlignmentFile(bam_path, "rb")
-    total_mapq = 0
-    count = 0
-    for read in bamfile.fetch():
-        if not read.is_unmapped:
-            total_mapq += read.mapping_quality
-            count += 1
-    bamfile.close()
-    return total_mapq / count if count > 0 else 0
+def _byte_sum(buf):
+    """Sum of the byte values of a buffer, without copying it"""
+    return int(np.frombuffer(buf, dtype=np.uint8).sum(dtype=np.int64))
 
 #%% Setting the input
 
-set_memory_limit_gb(16)  # Set limit to 16 GB of RAM
+START_TIME = time.monotonic()  # The runtime written to the report is measured from here
+
+MEMORY_LIMIT_GB = 16
+set_memory_limit_gb(MEMORY_LIMIT_GB)  # Set limit to 16 GB of RAM
 
 args = parse_args() # Read the imputs
 
@@ -157,23 +245,27 @@ REFERENCE_GENOME_PATH = args.reference
 RESULTS_DIR = args.output_dir
 NUM_THREADS = args.threads
 
+SORT_MEM_PER_THREAD_MB = sort_memory_per_thread_mb(NUM_THREADS, REFERENCE_GENOME_PATH, MEMORY_LIMIT_GB)
+
 IS_PAIRED_END = bool(READ2_FASTQ_PATH)
 
 OUTPUT_BAM_BASENAME = "aligned_reads.bam"
 OUTPUT_STATS_BASENAME = "temp_raw_stats"
 
-UNSORTED_SAM = os.path.join(RESULTS_DIR, "temp_aligned.sam")
-UNSORTED_BAM = os.path.join(RESULTS_DIR, "temp_unsorted.bam")
 SORTED_BAM = os.path.join(RESULTS_DIR, OUTPUT_BAM_BASENAME)
 SORTED_BAI = SORTED_BAM + ".bai"
-ALIGNMENT_STATS_FILE = os.path.join(RESULTS_DIR, OUTPUT_STATS_BASENAME)
+if args.keep_intermediates == "no":
+    # Not kept: write it to RAM when possible, and remove it automatically at exit
+    ALIGNMENT_STATS_FILE = temporary_file_path(RESULTS_DIR, OUTPUT_STATS_BASENAME + "_")
+else:
+    ALIGNMENT_STATS_FILE = os.path.join(RESULTS_DIR, OUTPUT_STATS_BASENAME)
 
 #%% Main function
 # --- Helper function for running commands ---
-def run_command(command, stdout_file=None, monitor_resources=False):
+def run_command(command, stdout_file=None, monitor_resources=False, sample_interval=5.0):
     """
     Runs a shell command.
-    If monitor_resources=True, tracks CPU and memory usage during execution.
+    If monitor_resources=True, tracks CPU and memory usage during execution (one sample every sample_interval seconds).
     Returns (success: bool, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem) if monitored,
     otherwise returns (success: bool).
 
@@ -183,9 +275,9 @@ def run_command(command, stdout_file=None, monitor_resources=False):
         try:
             if stdout_file:
                 with open(stdout_file, 'w') as f_out:
-                    process = subprocess.run(command, stdout=f_out, stderr=subprocess.PIPE, text=True, check=True)
+                    process = subprocess.run(command, stdout=f_out, stderr=subprocess.PIPE, text=True, check=True, preexec_fn=release_memory_limit)
             else:
-                process = subprocess.run(command, capture_output=True, text=True, check=True)
+                process = subprocess.run(command, capture_output=True, text=True, check=True, preexec_fn=release_memory_limit)
 
             if process.stderr:
                 print(f"Stderr (if any):\n{process.stderr}")
@@ -208,51 +300,152 @@ def run_command(command, stdout_file=None, monitor_resources=False):
 
     else:
         # Run with resource monitoring
-        max_cpu = 0.0
-        max_mem = 0.0
-        cpu_samples = []
-        mem_samples = []
+        f_out = open(stdout_file, 'w') if stdout_file else None
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE if not stdout_file else open(stdout_file, 'w'), stderr=subprocess.PIPE)
-            p = psutil.Process(process.pid)
-
-            while True:
-                if process.poll() is not None:
-                    break
-
-                cpu = p.cpu_percent(interval=1) # Check CPU usage
-                mem = p.memory_info().rss / (1024 * 1024)  # Memory in MB
-
-                cpu_samples.append(cpu)
-                mem_samples.append(mem)
-
-            # Final communicate to clean buffers
-            stdout, stderr = process.communicate()
-
-            # Calculate min, max, avg
-            min_cpu = min(cpu_samples) if cpu_samples else 0.0
-            max_cpu = max(cpu_samples) if cpu_samples else 0.0
-            avg_cpu = sum(cpu_samples) / len(cpu_samples) if cpu_samples else 0.0
-
-            min_mem = min(mem_samples) if mem_samples else 0.0
-            max_mem = max(mem_samples) if mem_samples else 0.0
-            avg_mem = sum(mem_samples) / len(mem_samples) if mem_samples else 0.0
-
-            print(f"Max CPU usage: {max_cpu:.2f}%, Average CPU usage: {avg_cpu:.2f}%")
-            print(f"Max Memory usage: {max_mem:.2f} MB, Average Memory usage: {avg_mem:.2f} MB")
+            process = subprocess.Popen(command, stdout=f_out or subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=release_memory_limit)
+            usage = monitor_process(process, sample_interval)
 
-            if stderr:
-                print(f"Stderr:\n{stderr.decode()}")
             if process.returncode != 0:
                 print(f"Error: Command failed with exit code {process.returncode}")
-                return False, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem
+                return (False,) + usage
 
-            return True, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem
+            return (True,) + usage
 
+        except FileNotFoundError:
+            print(f"Error: Command '{command[0]}' not found. Make sure it's in your PATH.")
+            return False, 0, 0, 0, 0, 0, 0
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
-            return False, 0, max_cpu, 0, 0, max_mem, 0
- 
+            return False, 0, 0, 0, 0, 0, 0
+        finally:
+            if f_out:
+                f_out.close()
+
+
+def monitor_process(process, sample_interval=5.0, others=()):
+    """
+    Samples CPU and memory usage of a running process every sample_interval seconds until it exits.
+    The processes in others (e.g. the rest of a pipeline) are sampled too, until they all exit,
+    and their memory is added to the one of process. The CPU usage is the one of process alone.
+    The first sample is taken after at most 1 second, so short runs are measured too.
+    min/max/sum are kept as running values, so memory does not grow with the run length.
+    Returns (min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem).
+    """
+    n_samples = n_cpu_samples = 0
+    min_cpu = max_cpu = sum_cpu = 0.0
+    min_mem = max_mem = sum_mem = 0.0
+    ps = [psutil.Process(proc.pid) for proc in (process, *others)]
+    for p in ps:
+        p.cpu_percent(interval=None)  # Prime the counter, later calls return immediately
+
+    # Drain stdout/stderr while sampling, otherwise the child blocks once a pipe buffer is full
+    output = {}
+    def drain():
+        output["stdout"], output["stderr"] = process.communicate()
+        for other in others:
+            other.wait()
+    drain_thread = threading.Thread(target=drain)
+    drain_thread.start()
+
+    # The drain thread ends with the processes, so joining with a timeout returns as soon as they exit
+    wait = min(1.0, sample_interval)
+    while True:
+        drain_thread.join(timeout=wait)
+        if not drain_thread.is_alive():
+            break
+        wait = sample_interval
+        cpu = None
+        mem = 0.0
+        for i, p in enumerate(ps):
+            try:
+                if i == 0:
+                    cpu = p.cpu_percent(interval=None) # Check CPU usage since the previous sample
+                mem += p.memory_info().rss / (1024 * 1024)  # Memory in MB
+            except psutil.NoSuchProcess:
+                pass  # Already exited
+
+        if cpu is not None:
+            min_cpu = cpu if n_cpu_samples == 0 else min(min_cpu, cpu)
+            max_cpu = max(max_cpu, cpu)
+            sum_cpu += cpu
+            n_cpu_samples += 1
+        min_mem = mem if n_samples == 0 else min(min_mem, mem)
+        max_mem = max(max_mem, mem)
+        sum_mem += mem
+        n_samples += 1
+
+    drain_thread.join()
+    stderr = output["stderr"]
+
+    # Calculate avg
+    avg_cpu = sum_cpu / n_cpu_samples if n_cpu_samples else 0.0
+    avg_mem = sum_mem / n_samples if n_samples else 0.0
+
+    print(f"Max CPU usage: {max_cpu:.2f}%, Average CPU usage: {avg_cpu:.2f}%")
+    print(f"Max Memory usage: {max_mem:.2f} MB, Average Memory usage: {avg_mem:.2f} MB")
+
+    if stderr:
+        print(f"Stderr:\n{stderr.decode()}")
+
+    return min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem
+
+
+def run_pipeline(source_command, sink_command, monitor_resources=False, sample_interval=5.0):
+    """
+    Runs two shell commands connected by a pipe (source_command | sink_command),
+    so the output of the first one never touches the disk.
+    If monitor_resources=True, tracks the CPU usage of source_command and the memory usage of both
+    commands together during execution (one sample every sample_interval seconds).
+    Returns (success: bool, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem) if monitored,
+    otherwise returns (success: bool).
+    """
+    usage = (0, 0, 0, 0, 0, 0)
+    source = None
+    try:
+        source = subprocess.Popen(source_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=release_memory_limit)
+        # sink writes its output to a file (-o) and its stderr to a temporary file, so no pipe of its own
+        # is left undrained (and blocking it) while source runs
+        with tempfile.TemporaryFile() as sink_stderr_file:
+            sink = subprocess.Popen(sink_command, stdin=source.stdout, stdout=subprocess.DEVNULL, stderr=sink_stderr_file, preexec_fn=release_memory_limit)
+            # Close the parent's copy of the pipe, so source gets SIGPIPE if sink exits early
+            source.stdout.close()
+
+            if monitor_resources:
+                usage = monitor_process(source, sample_interval, others=(sink,))
+            else:
+                _, source_stderr = source.communicate()
+                if source_stderr:
+                    print(f"Stderr (if any):\n{source_stderr.decode()}")
+
+            sink.wait()
+            sink_stderr_file.seek(0)
+            sink_stderr = sink_stderr_file.read()
+        if sink_stderr:
+            print(f"Stderr (if any):\n{sink_stderr.decode()}")
+
+        success = True
+        for cmd, proc in ((source_command, source), (sink_command, sink)):
+            if proc.returncode != 0:
+                print(f"Error: Command failed with exit code {proc.returncode}")
+                print(f"Command: {' '.join(cmd)}")
+                success = False
+
+    except FileNotFoundError as e:
+        print(f"Error: Command '{e.filename}' not found. Make sure it's in your PATH.")
+        success = False
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        success = False
+
+    # If sink could not be started, do not leave source running (or blocked on its full pipe)
+    if source is not None and source.poll() is None:
+        source.kill()
+        source.communicate()
+
+    if monitor_resources:
+        return (success,) + usage
+    return success
+
 
 print("\nStarting BWA-MEM Alignment Pipeline with predefined paths...")
 print(f"Reference: {REFERENCE_GENOME_PATH}")
@@ -262,96 +455,76 @@ if IS_PAIRED_END:
 print(f"Output BAM: {SORTED_BAM}")
 print(f"Output Stats: {ALIGNMENT_STATS_FILE}")
 print(f"Threads: {NUM_THREADS}")
-print(f"Intermediate SAM: {UNSORTED_SAM}")
-print(f"Intermediate Unsorted BAM: {UNSORTED_BAM}")
 
 
 
 #%%
 
-# --- STEP 1: Aligning reads with bwa mem (saving to SAM) ---------------
-print(f"\n--- STEP 1: Aligning reads with bwa mem (output SAM to {UNSORTED_SAM}) ---")
+# --- STEP 1: Aligning reads with bwa mem, piped straight into samtools sort ---------------
+print(f"\n--- STEP 1: Aligning reads with bwa mem, sorting and indexing with samtools (output to {SORTED_BAM}) ---")
 
-bwa_mem_cmd = ["bwa", "mem", "-t", str(NUM_THREADS), "-M", REFERENCE_GENOME_PATH, READ1_FASTQ_PATH]
+# -K fixes the number of bases processed per batch: smaller first-batch latency with many threads,
+# and the output no longer depends on the number of threads
+bwa_mem_cmd = ["bwa", "mem", "-t", str(NUM_THREADS), "-K", "10000000", "-M", REFERENCE_GENOME_PATH, READ1_FASTQ_PATH]
 if IS_PAIRED_END:
     bwa_mem_cmd.append(READ2_FASTQ_PATH)
 
+# samtools sort reads the SAM stream from stdin ("-"), so no intermediate SAM/BAM is written,
+# and builds the .bai index while writing the sorted BAM (--write-index)
+samtools_sort_cmd = ["samtools", "sort", "-@", str(NUM_THREADS), "-m", f"{SORT_MEM_PER_THREAD_MB}M", "-l", "6",
+                     "--write-index", "-o", f"{SORTED_BAM}##idx##{SORTED_BAI}", "-"]
+
 # bwa mem with resource usage tracking
-success, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem = run_command(bwa_mem_cmd, stdout_file=UNSORTED_SAM, monitor_resources=True)
+success, min_cpu, max_cpu, avg_cpu, min_mem, max_mem, avg_mem = run_pipeline(bwa_mem_cmd, samtools_sort_cmd, monitor_resources=True)
 
 if not success:
-    print("Pipeline failed at BWA MEM step.")
+    print("Pipeline failed at BWA MEM alignment and sorting step.")
     sys.exit(1)
+print(f"Sorted BAM file created: {SORTED_BAM}")
+print(f"BAM index file created: {SORTED_BAI}")
 
-max_cpu_limit = NUM_THREADS * 100 # cpu in percentage
+max_cpu_limit = NUM_THREADS * 100 # cpu in percentage, of bwa mem (-t NUM_THREADS); samtools sort has its own -@ threads
 if max_cpu_limit is not None and max_cpu > max_cpu_limit:
     print(f"WARNING: CPU usage exceeded limit: {max_cpu:.2f}% > {max_cpu_limit}%")
 
-max_mem_limit = 16 * 1024  # Memory is limited to 16 GB anyway from line 150 set_memory_limit_gb(16)
+max_mem_limit = MEMORY_LIMIT_GB * 1024  # Same 16 GB budget as the script, monitored for bwa and samtools sort together (not enforced on children)
 if max_mem_limit is not None and max_mem > max_mem_limit:
     print(f"WARNING: Memory usage exceeded limit: {max_mem:.2f} MB > {max_mem_limit} MB")
 
 
+# --- STEP 2: Collecting Alignment Statistics ------------------
+# A single samtools stats pass gives the read counts and the average MAPQ
+print(f"\n--- STEP 2: Collecting Alignment Statistics with samtools stats (output to {ALIGNMENT_STATS_FILE}) ---")
+samtools_stats_cmd = ["samtools", "stats", "-@", str(NUM_THREADS), SORTED_BAM]
 
-# --- STEP 2: Converting SAM to Unsorted BAM ------------------
-print(f"\n--- STEP 2: Converting SAM to Unsorted BAM  with samtools (output to {UNSORTED_BAM}) ---")
-samtools_view_cmd = ["samtools", "view", "-b", UNSORTED_SAM] # -b means output BAM
-
-if not run_command(samtools_view_cmd, stdout_file=UNSORTED_BAM):
-    print("Pipeline failed at SAM to BAM conversion step.")
-    sys.exit(1)
-print(f"Unsorted BAM file created: {UNSORTED_BAM}")
-
-# --- STEP 3: Sorting BAM file by coordinate ------------------
-print(f"\n--- STEP 3: Sorting BAM file with samtools (output to {SORTED_BAM}) ---")
-samtools_sort_cmd = ["samtools", "sort", UNSORTED_BAM, "-o", SORTED_BAM]
-
-if not run_command(samtools_sort_cmd):
-    print("Pipeline failed at BAM sorting step.")
-    sys.exit(1)
-print(f"Sorted BAM file created: {SORTED_BAM}")
-
-
-# --- STEP 4: Indexing the Sorted BAM file ------------------
-print(f"\n--- STEP 4: Indexing the Sorted BAM file with samtools (output to {SORTED_BAI}) ---")
-samtools_index_cmd = ["samtools", "index", SORTED_BAM]
-
-if not run_command(samtools_index_cmd):
-    print("Pipeline failed at BAM indexing step.")
-    sys.exit(1)
-print(f"BAM index file created: {SORTED_BAI}")
-
-
-# --- STEP 5: Collecting Alignment Statistics ------------------
-print(f"\n--- STEP 5: Collecting Alignment Statistics with samtools (output to {ALIGNMENT_STATS_FILE}) ---")
-samtools_flagstat_cmd = ["samtools", "flagstat", SORTED_BAM]
-
-if not run_command(samtools_flagstat_cmd, stdout_file=ALIGNMENT_STATS_FILE):
+if not run_command(samtools_stats_cmd, stdout_file=ALIGNMENT_STATS_FILE):
     print("Pipeline failed at alignment statistics collection step.")
     sys.exit(1)
 print(f"Alignment statistics saved to: {ALIGNMENT_STATS_FILE}")
 
 print("\nPipeline finished successfully!")
 
-# --- STEP 5: Prepare the human-readable report ------------------
+# --- STEP 3: Prepare the human-readable report ------------------
 report_txt = args.stats
-parse_flagstat(ALIGNMENT_STATS_FILE, report_txt)
+avg_mapq = parse_samtools_stats(ALIGNMENT_STATS_FILE, report_txt)
 
-# Calculate average base quality (Phred) for read1 and possibly read2
-avg_base_qual_1 = average_base_quality(READ1_FASTQ_PATH)
-if READ2_FASTQ_PATH:
-    avg_base_qual_2 = average_base_quality(READ2_FASTQ_PATH)
-    avg_base_qual = (avg_base_qual_1 + avg_base_qual_2) / 2
-else:
-    avg_base_qual = avg_base_qual_1
+# Calculate average base quality (Phred) for read1 and possibly read2.
+# The scans are independent, so run them in parallel processes (fork, so the
+# workers do not re-import and re-run this script). The threads are split between
+# the scans, so their decompressions together stay within NUM_THREADS
+fastq_paths = [READ1_FASTQ_PATH, READ2_FASTQ_PATH] if IS_PAIRED_END else [READ1_FASTQ_PATH]
+scan_threads = max(1, NUM_THREADS // len(fastq_paths))
+with ProcessPoolExecutor(max_workers=len(fastq_paths), mp_context=multiprocessing.get_context("fork")) as pool:
+    base_quals = list(pool.map(average_base_quality, fastq_paths, [scan_threads] * len(fastq_paths)))
 
-# Calculate average MAPQ from BAM
-avg_mapq = average_mapping_quality(SORTED_BAM)
+avg_base_qual = sum(base_quals) / len(base_quals)
 
 # Read the existing alignment statistics
 with open(report_txt, "r") as f:
     flagstat_report = f.read()
 
+aligner_runtime = time.monotonic() - START_TIME
+
 # Append the additional stats to the report
 with open(report_txt, "a") as f:
     f.write("\n")
@@ -361,26 +534,8 @@ with open(report_txt, "a") as f:
     f.write(f"CPU usage (%) - min: {min_cpu:.2f}, max: {max_cpu:.2f}, avg: {avg_cpu:.2f}\n")
     f.write(f"Max Memory usage (MB): {max_mem:.2f}\n")
     f.write(f"Memory usage (MB) - min: {min_mem:.2f}, max: {max_mem:.2f}, avg: {avg_mem:.2f}\n")
+    f.write(f"Aligner runtime (s): {aligner_runtime:.2f}\n")
 
 print(f"Average base quality (Phred): {avg_base_qual:.2f}")
 print(f"Average mapping quality (MAPQ): {avg_mapq:.2f}")
-
-
-
-#%%
-# --- Optional: Clean up intermediate files ---
-if args.keep_intermediates == "no":
-    # print("\nCleaning up intermediate files...")
-    try:
-        if os.path.exists(UNSORTED_SAM):
-            os.remove(UNSORTED_SAM)
-            print(f"Removed: {UNSORTED_SAM}")
-        if os.path.exists(UNSORTED_BAM):
-            os.remove(UNSORTED_BAM)
-            print(f"Removed: {UNSORTED_BAM}")
-        if os.path.exists(ALIGNMENT_STATS_FILE):
-            os.remove(ALIGNMENT_STATS_FILE)
-            print(f"Removed: {ALIGNMENT_STATS_FILE}")
-    except OSError as e:
-        print(f"Error during cleanup: {e}")
-
+print(f"Aligner runtime: {aligner_runtime:.2f} s")
@@ -1,38 +1,124 @@
 import csv
-import subprocess
 import os
+from dataclasses import dataclass
 from pathlib import Path
+import pytest
+
+from generate_report import generate_markdown
+from test_support.bwa_shm import drop_pinned
 
 
 test_results = []
 
+@dataclass(frozen=True, slots=True)
+class RunMeta:
+    """ Inputs of a test run, reported in the results. test_name and acceptance_criteria, when given,
+    replace the ones taken from the test function (e.g. for the cases of a table-driven test) """
+    reads_R1: str
+    reads_R2: str
+    reference: str
+    threads: int
+    test_name: str | None = None
+    acceptance_criteria: str | None = None
+
+# RunMeta recorded by the tests of this process, keyed by test node id
+REGISTRY: dict[str, RunMeta] = {}
+
+@pytest.fixture
+def record_run_meta(request):
+    """ Record the RunMeta of the running test: record_run_meta(reads_R1=..., reads_R2=..., reference=..., threads=...) """
+    def record(**fields):
+        REGISTRY[request.node.nodeid] = RunMeta(**fields)
+    return record
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "inputs(*paths): input files the test needs, it is skipped when one is missing")
+    config.addinivalue_line("markers", "needs_disk: writes large outputs, run it with ALIGNER_TMPDIR on a real disk rather than tmpfs")
+    config.addinivalue_line("markers", "xdist_group(name): cases aligning the same inputs, kept on one worker by --dist loadgroup")
+    config.addinivalue_line("markers", "prefetch(key): run the cases of the parametrized test concurrently, key(params) gives their aligner inputs")
+
+def pytest_collection_modifyitems(config, items):
+    # Skip up front the tests whose input files (reads, reference FASTA) are missing,
+    # instead of letting them fail inside the aligner run. A missing bwa index is not a reason
+    # to skip, the tests build it before the first alignment against that reference
+    exists = {}
+    for item in items:
+        missing = []
+        for marker in item.iter_markers("inputs"):
+            for path in marker.args:
+                if not path:
+                    continue  # No read2, single-end case
+                if path not in exists:
+                    exists[path] = os.path.exists(path)
+                if not exists[path]:
+                    missing.append(path)
+        if missing:
+            item.add_marker(pytest.mark.skip(reason=f"Missing input files: {', '.join(missing)}"))
+
+@pytest.hookimpl(hookwrapper=True)
 def pytest_runtest_makereport(item, call):
     # This hook is called when a test phase finishes
-    # I want only the 'call' phase (test execution)
-    if call.when == "call":
-        outcome = "PASS" if call.excinfo is None else "FAIL"
+    # I want the 'call' phase (test execution), and the 'setup' phase of the tests skipped before running
+    # (e.g. missing inputs), so that every test gets its row in the results
+    outcome = yield
+    report = outcome.get_result()
+    if call.when == "call" or (call.when == "setup" and report.skipped):
+        if report.skipped:
+            result = "SKIP"
+            # longrepr of a skip is (path, lineno, "Skipped: <reason>")
+            reason = report.longrepr[2] if isinstance(report.longrepr, tuple) else str(report.longrepr)
+            reason = reason.removeprefix("Skipped: ")
+        else:
+            result = "PASS" if call.excinfo is None else "FAIL"
+            reason = ""
 
-        # Extract custom metadata from test function attributes
-        test_name = getattr(item.function, "test_name", item.name)
+        # Inputs recorded by the test (record_run_meta fixture), none for a test skipped before running
+        meta = REGISTRY.pop(item.nodeid, None)
+        # Parameters of a table-driven test (name, criteria), used when the test did not record its own
+        params = item.callspec.params if hasattr(item, "callspec") else {}
 
-        # get the docstring as acceptance criteria (if you want)
-        acceptance_criteria = (item.function.__doc__ or "").strip().split('\n')[0]
+        # Extract the test name from the test function attribute, unless the test recorded its own
+        if meta and meta.test_name:
+            test_name = meta.test_name
+        else:
+            test_name = params.get("name") or getattr(item.function, "test_name", item.name)
 
-        metadata = getattr(item.function, "metadata", {})
+        # get the docstring as acceptance criteria (if you want), unless the test recorded its own
+        if meta and meta.acceptance_criteria:
+            acceptance_criteria = meta.acceptance_criteria
+        elif params.get("criteria"):
+            acceptance_criteria = params["criteria"]
+        else:
+            acceptance_criteria = (item.function.__doc__ or "").strip().split('\n')[0]
 
-        test_results.append({
+        row = {
             "requirement": test_name.upper(),
             "acceptance_criteria": acceptance_criteria,
             "test_case": item.name,
-            "result": outcome,
-            "reads_R1": metadata.get("reads_R1", ""),
-            "reads_R2": metadata.get("reads_R2", ""),
-            "reference": metadata.get("reference", ""),
-            "threads": metadata.get("threads", "")
-        })
+            "result": result,
+            "reads_R1": meta.reads_R1 if meta else "",
+            "reads_R2": meta.reads_R2 if meta else "",
+            "reference": meta.reference if meta else "",
+            "threads": meta.threads if meta else "",
+            "reason": reason
+        }
+        # Attach the row to the report, so it also reaches the main process when running with pytest-xdist
+        report.user_properties.append(("test_result", row))
+
+def pytest_runtest_logreport(report):
+    # Called in the main process for every report, including the ones sent by pytest-xdist workers
+    if report.when in ("setup", "call"):
+        test_results.extend(value for name, value in report.user_properties if name == "test_result")
 
 def pytest_sessionfinish(session, exitstatus):
-    
+    # With pytest-xdist only the main process writes the results, the workers just send their reports
+    if hasattr(session.config, "workerinput"):
+        return
+
+    # Drop the indexes the tests loaded in bwa shared memory,
+    # here in the main process so no pytest-xdist worker still needs them
+    drop_pinned()
+
     cwd = Path(os.getcwd())
     test_result_dir = cwd / "output"
     test_result_dir.mkdir(parents=True, exist_ok=True)
@@ -42,17 +128,16 @@ def pytest_sessionfinish(session, exitstatus):
 
     with open(csv_file, "w", newline='', encoding="utf-8") as f:
         fieldnames = ["requirement", "acceptance_criteria", "test_case", "result",
-                    "reads_R1", "reads_R2", "reference", "threads"]
+                    "reads_R1", "reads_R2", "reference", "threads", "reason"]
         writer = csv.DictWriter(f, fieldnames)
         writer.writeheader()
-        for row in test_results:
-            writer.writerow(row)
+        writer.writerows(test_results)
     print(" CSV file written: test_results.csv")
 
-    # Auto-generate Markdown report calling generate_report.py
+    # Auto-generate Markdown report with generate_report.py (in-process, no extra interpreter)
     report_file = os.path.join(test_result_dir, "test_report.md")
     try:
-        subprocess.run(["python", "generate_report.py", "-i", csv_file, "-o", report_file], check=True)
+        generate_markdown(csv_file, report_file)
         print(" Markdown report generated: test_report.md")
     except Exception as e:
         print(" Could not generate Markdown report:", e)
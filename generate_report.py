@@ -4,35 +4,35 @@ from datetime import datetime
 import os
 
 def generate_markdown(input_csv, output_md):
-    with open(input_csv, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows = list(reader)
-
     date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    report_lines = []
-    report_lines.append(f"# Date {date_str}\n")
-    report_lines.append("# Test results:\n")
-
-    for row in rows:
-        req = row["requirement"]
-        criteria = row["acceptance_criteria"]
-        reads = row.get("reads_R1", "")
-        if row.get("reads_R2"):
-            reads += f" + {row['reads_R2']}"
-        reference = row.get("reference", "")
-        threads = row.get("threads", "")
-        result = row["result"]
-
-        report_lines.append(f"## Test {req}")
-        report_lines.append(f"Acceptance criteria: {criteria}")
-        report_lines.append(f"Reads used: {reads}")
-        report_lines.append(f"Reference genome: {reference}")
-        report_lines.append(f"Threads: {threads}")
-        report_lines.append(f"Result: {result}\n")
-
-    with open(output_md, "w", encoding="utf-8") as f:
-        f.write("\n".join(report_lines))
+    # Stream the rows straight from the CSV into the report, one block per test
+    with open(input_csv, newline='', encoding='utf-8') as csvfile, open(output_md, "w", encoding="utf-8") as f:
+        reader = csv.DictReader(csvfile)
+
+        f.write(f"# Date {date_str}\n\n")
+        f.write("# Test results:\n")
+
+        for row in reader:
+            req = row["requirement"]
+            criteria = row["acceptance_criteria"]
+            reads = row.get("reads_R1", "")
+            if row.get("reads_R2"):
+                reads += f" + {row['reads_R2']}"
+            reference = row.get("reference", "")
+            threads = row.get("threads", "")
+            result = row["result"]
+            reason = row.get("reason", "")
+
+            f.write("\n")
+            f.write(f"## Test {req}\n")
+            f.write(f"Acceptance criteria: {criteria}\n")
+            f.write(f"Reads used: {reads}\n")
+            f.write(f"Reference genome: {reference}\n")
+            f.write(f"Threads: {threads}\n")
+            f.write(f"Result: {result}\n")
+            if reason:
+                f.write(f"Reason: {reason}\n")
 
     print(f"Markdown report generated: {output_md}")
     # # Delete the input CSV file after report generation
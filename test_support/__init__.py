@@ -0,0 +1 @@
+""" Helpers of the tests (test_aligner.py, conftest.py) """
@@ -0,0 +1,66 @@
+""" bwa shared memory (bwa shm) handling of the tests: test_aligner.py loads the reference indexes,
+conftest.py drops them at the end of the session. """
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from filelock import FileLock
+
+# Where bwa shm copies the indexes (POSIX shared memory)
+BWA_SHM_DIR = "/dev/shm"
+
+# Marker left when the tests loaded the bwa shared memory themselves, the indexes are then dropped at the end of the session
+BWA_SHM_MARKER = os.path.join(tempfile.gettempdir(), "aligner_bwa_shm.staged")
+
+def loaded_indexes():
+    """ Names of the indexes loaded in shared memory by bwa shm (empty set if none), or None when bwa is not available """
+    try:
+        listed = subprocess.run(["bwa", "shm", "-l"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return {line.split("\t")[0] for line in listed.stdout.splitlines() if line.strip()}
+
+def pin_reference(reference, index_files):
+    """ Best effort: load the index once in shared memory with bwa shm, so the following bwa mem runs against it
+    (any worker) map that copy instead of reading the whole index from disk again. bwa mem finds it by itself,
+    by the index name. If bwa shm can not be used here (e.g. a too small /dev/shm, 64 MB by default in Docker)
+    the runs just read from disk."""
+    with FileLock(os.path.join(tempfile.gettempdir(), "aligner_bwa_shm.lock")):
+        loaded = loaded_indexes()
+        if loaded is None or os.path.basename(reference) in loaded:
+            return
+        # bwa shm can only drop everything, so nothing is loaded next to indexes someone else loaded
+        # before the tests (loaded and no marker): it could never be dropped
+        if loaded and not os.path.exists(BWA_SHM_MARKER):
+            print(f"Not loading {reference} in bwa shared memory: it already holds other indexes ({', '.join(sorted(loaded))}).")
+            return
+
+        # bwa shm lists the index name before copying the data, and dies with SIGBUS when /dev/shm fills up,
+        # leaving a partial index that every later bwa mem would load by name. So only try when it fits
+        index_size = sum(os.path.getsize(path) for path in index_files)
+        try:
+            shm_stat = os.statvfs(BWA_SHM_DIR)
+        except OSError:
+            return
+        shm_free = shm_stat.f_bavail * shm_stat.f_frsize
+        if shm_free < index_size:
+            print(f"Not loading {reference} in bwa shared memory: {shm_free // 2**20} MB free in {BWA_SHM_DIR}, "
+                  f"{index_size // 2**20} MB needed.")
+            return
+
+        staged = subprocess.run(["bwa", "shm", reference], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if staged.returncode != 0:
+            # bwa shm can only drop everything: a partially loaded index would break every bwa mem run anyway
+            print(f"bwa shm failed for {reference} (exit code {staged.returncode}), dropping the bwa shared memory.")
+            subprocess.run(["bwa", "shm", "-d"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if os.path.exists(BWA_SHM_MARKER):
+                os.remove(BWA_SHM_MARKER)
+            return
+        # Everything in the shared memory is now ours, to drop at the end of the session
+        Path(BWA_SHM_MARKER).touch()
+
+def drop_pinned():
+    """ Drop the indexes loaded in bwa shared memory by pin_reference, never the ones loaded by someone else """
+    if os.path.exists(BWA_SHM_MARKER):
+        subprocess.run(["bwa", "shm", "-d"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.remove(BWA_SHM_MARKER)
@@ -0,0 +1,138 @@
+""" Reference preparation of the tests: merge of the split hg38 .bwt, bwa index and bwa shared memory. """
+import hashlib
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import pytest
+from filelock import FileLock
+
+from test_support import bwa_shm
+
+# Chunk size of the merge when sendfile is not available
+MERGE_COPY_CHUNK = 16 * 1024 * 1024
+
+def merge_parts_if_missing(base_filename):
+    """ This function is needed because I am limited to upload data to github. And i want the docker to be built as requested,
+     being able to run end-to-end using hg38 full reference genome"""
+    parts = find_parts(base_filename)
+    if os.path.exists(base_filename):
+        # Without parts there is nothing to check it against, so it is used as it is
+        if not parts or merged_file_is_valid(base_filename, parts):
+            print(f"{base_filename} already exists, skipping merge.")
+            return
+        print(f"{base_filename} does not match the checksum of its parts, merging again.")
+
+    if not parts:
+        print(f"No parts found matching {base_filename}_part_*. Cannot merge.")
+        return
+    
+    print(f"Merging parts into {base_filename}...")
+    # Merged under a temporary name, so an interrupted merge never leaves a truncated index
+    merging_filename = base_filename + ".merging"
+    with open(merging_filename, 'wb', buffering=0) as wfd:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(wfd.fileno(), 0, sum(os.path.getsize(part) for part in parts))
+            except OSError:
+                pass
+        for part in parts:
+            with open(part, 'rb') as fd:
+                copy_part(fd, wfd)
+    digest = files_digest(parts)
+    os.replace(merging_filename, base_filename)
+    write_checksum(base_filename, digest)
+    print("Merge completed.")
+
+def files_digest(paths):
+    """ blake2b hex digest of the concatenation of the files """
+    digest = hashlib.blake2b()
+    for path in paths:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue  # mmap can not map an empty file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.hexdigest()
+
+def write_checksum(base_filename, digest):
+    """ Record the digest, size and mtime of the merged file in <base_filename>.blake2b """
+    stat = os.stat(base_filename)
+    with open(base_filename + ".blake2b", "w") as f:
+        f.write(f"{digest} {stat.st_size} {stat.st_mtime_ns}\n")
+
+def merged_file_is_valid(base_filename, parts):
+    """ Check a merged file against its parts. The recorded checksum is trusted while size and mtime are unchanged;
+    without one (older merge) the file is compared with the parts once and the checksum recorded on a match """
+    stat = os.stat(base_filename)
+    try:
+        with open(base_filename + ".blake2b") as f:
+            digest, size, mtime_ns = f.read().split()
+        size, mtime_ns = int(size), int(mtime_ns)
+    except (OSError, ValueError):
+        digest, size, mtime_ns = None, sum(os.path.getsize(part) for part in parts), None
+    if stat.st_size != size:
+        return False
+    if stat.st_mtime_ns == mtime_ns:
+        return True
+    if digest is None:
+        digest = files_digest(parts)
+    if files_digest([base_filename]) != digest:
+        return False
+    write_checksum(base_filename, digest)  # Same content: record the checksum with the current mtime
+    return True
+
+def find_parts(base_filename):
+    """ Paths of the <base_filename>_part_<suffix> files in merge order (shorter suffixes first: aa, ab, ..., zaaa or 1, 2, ..., 10) """
+    prefix = os.path.basename(base_filename) + "_part_"
+    with os.scandir(os.path.dirname(base_filename) or ".") as entries:
+        parts = [(entry.name[len(prefix):], entry.path) for entry in entries
+                 if entry.name.startswith(prefix) and entry.is_file()]
+    parts.sort(key=lambda part: (len(part[0]), part[0]))
+    return [path for _, path in parts]
+
+def copy_part(fd, wfd):
+    """ Append a whole part to the merged file, with sendfile when available """
+    size = os.fstat(fd.fileno()).st_size
+    offset = 0
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < size:
+                sent = os.sendfile(wfd.fileno(), fd.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            if offset:
+                raise
+    shutil.copyfileobj(fd, wfd, length=MERGE_COPY_CHUNK)
+
+# Index files bwa mem loads next to the reference FASTA
+BWA_INDEX_SUFFIXES = (".amb", ".ann", ".bwt", ".pac", ".sa")
+
+# References made ready for alignment in this process
+prepared_references = set()
+
+def prepare_reference(reference, split_bwt=False):
+    """ Get a reference ready before its first alignment: merge its .bwt from parts (split_bwt), or build a missing
+    index with bwa index, then load it in bwa shared memory. Done under a file lock shared by the pytest-xdist workers."""
+    if reference in prepared_references:
+        return
+    lock_name = f"aligner_prepare_{os.path.basename(reference)}.lock"
+    with FileLock(os.path.join(tempfile.gettempdir(), lock_name)):
+        if split_bwt:
+            merge_parts_if_missing(reference + ".bwt")
+            if not os.path.exists(reference + ".bwt"):
+                pytest.skip(f"Cannot merge {reference}.bwt: its parts ({reference}.bwt_part_*) "
+                            "are missing or not pulled (git lfs pull)")
+        missing = [reference + suffix for suffix in BWA_INDEX_SUFFIXES if not os.path.exists(reference + suffix)]
+        # A partial index is never rebuilt, that would overwrite the committed index files
+        if len(missing) == len(BWA_INDEX_SUFFIXES):
+            print(f"Building the bwa index of {reference}...")
+            subprocess.run(["bwa", "index", reference], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        elif missing:
+            pytest.fail(f"Incomplete bwa index for {reference}, missing: {', '.join(missing)}")
+    bwa_shm.pin_reference(reference, [reference + suffix for suffix in BWA_INDEX_SUFFIXES])
+    prepared_references.add(reference)
@@ -0,0 +1,44 @@
+""" Scheduling of the aligner runs of the tests: hg38 slots shared by the pytest-xdist workers, background runs. """
+import contextlib
+import os
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import psutil
+from filelock import FileLock, Timeout
+
+# Concurrent hg38 alignments (pytest -n) each need the 16 GB memory budget of the aligner,
+# so at most one hg38 run per 16 GB of RAM is allowed at a time, shared by all workers
+hg38_slots = max(1, psutil.virtual_memory().total // (16 * 1024 ** 3))
+
+@contextlib.contextmanager
+def hg38_slot():
+    """ Hold one of the hg38_slots file locks (in the system temp dir, so shared by the pytest-xdist workers) """
+    while True:
+        for slot in range(hg38_slots):
+            lock = FileLock(os.path.join(tempfile.gettempdir(), f"aligner_hg38_slot_{slot}.lock"))
+            try:
+                lock.acquire(timeout=0)
+            except Timeout:
+                continue
+            try:
+                yield
+            finally:
+                lock.release()
+            return
+        time.sleep(1)
+
+def start_runs(cache, keys, run):
+    """ Start run(*key) in background threads for the keys not in cache yet, storing their Futures in cache """
+    missing = [key for key in keys if key not in cache]
+    if not missing:
+        return
+    # The work is done by the aligner subprocesses, threads only wait for them
+    pool = ThreadPoolExecutor(max_workers=len(missing))
+    for key in missing:
+        cache[key] = pool.submit(run, *key)
+    pool.shutdown(wait=False)
+
+def wait_runs(cache, keys):
+    """ Wait for the background runs of keys still running """
+    wait([cache[key] for key in keys if isinstance(cache.get(key), Future)])